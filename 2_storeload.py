@@ -1,10 +1,22 @@
 import struct
+import sys
+
+# Opcode names, interned so execute() can compare them with "is" (a pointer
+# check) rather than "==".  Names written as literals in code lists are
+# interned by Python already.  Code built at run time (by a parser, say)
+# needs to pass its names through sys.intern() as it builds the list.
+OP_CONST = sys.intern("const")
+OP_ADD = sys.intern("add")
+OP_MUL = sys.intern("mul")
+OP_LOAD = sys.intern("load")
+OP_STORE = sys.intern("store")
 
 
 class Machine:
     def __init__(self, memsize=65536):
         self.items = []
         self.memory = bytearray(memsize)
+        self.trace = False  # Print each instruction as it runs
 
     def load(self, addr):
         return struct.unpack("<d", self.memory[addr : addr + 8])[0]
@@ -20,21 +32,22 @@ class Machine:
 
     def execute(self, instructions):
         for op, *args in instructions:
-            print(op, args, self.items)
-            if op == "const":
+            if __debug__ and self.trace:
+                print(op, args, self.items)
+            if op is OP_CONST:
                 self.push(args[0])
-            elif op == "add":
+            elif op is OP_ADD:
                 right = self.pop()
                 left = self.pop()
                 self.push(left + right)
-            elif op == "mul":
+            elif op is OP_MUL:
                 right = self.pop()
                 left = self.pop()
                 self.push(left * right)
-            elif op == "load":
+            elif op is OP_LOAD:
                 addr = self.pop()
                 self.push(self.load(addr))
-            elif op == "store":
+            elif op is OP_STORE:
                 var = self.pop()
                 addr = self.pop()
                 self.store(addr, var)
@@ -1,4 +1,259 @@
 import struct
+from array import array
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Integer opcodes.  Instructions are rewritten from ("name", *args) tuples
+# into (opcode, args) pairs once, which is what the compile passes below
+# work on.  As a last step _thread() swaps each opcode for its handler.
+# This all happens when a Function is created, see _compile().
+CONST = 0
+ADD = 1
+MUL = 2
+LOAD = 3
+STORE = 4
+LOCAL_GET = 5
+LOCAL_SET = 6
+CALL = 7
+SUB = 8
+BR = 9
+BR_IF = 10
+BLOCK = 11
+LOOP = 12
+RETURN = 13
+LE = 14
+GE = 15
+
+_opcodes = {
+    "const": CONST,
+    "add": ADD,
+    "mul": MUL,
+    "load": LOAD,
+    "store": STORE,
+    "local.get": LOCAL_GET,
+    "local.set": LOCAL_SET,
+    "call": CALL,
+    "sub": SUB,
+    "br": BR,
+    "br_if": BR_IF,
+    "block": BLOCK,
+    "loop": LOOP,
+    "return": RETURN,
+    "le": LE,
+    "ge": GE,
+}
+
+# Superinstructions.  These never appear in source code; _fuse() swaps
+# them in for common runs of instructions so each run is one dispatch.
+LOAD_CONST = 16  # const A; load
+PUSH_CONST_AND_LOAD = 17  # const A; const A; load
+MADD_LOCALS = 18  # local.get i; local.get j; local.get k; mul; add
+
+# Memory holds little-endian f64 values at any byte offset
+_f64 = struct.Struct("<d")
+
+
+def _compile(instructions):
+    # Nested block/loop bodies are flattened into one list, and branches
+    # become jumps to an absolute instruction index: the end of a block or
+    # the start of a loop.  The body itself is the outermost block, so a
+    # return is just a branch to the end.
+    code = []
+    end = []
+    _flatten(instructions, code, [end])
+    _resolve(code, end)
+    return _thread(_fuse(code))
+
+
+def _flatten(instructions, code, labels):
+    # labels has one entry per enclosing block/loop, innermost last.  A loop
+    # is its start index; a block is the list of branches still waiting to
+    # learn where it ends.
+    for op, *args in instructions:
+        if op not in _opcodes:
+            raise RuntimeError(f"Bad op {op}")
+        opcode = _opcodes[op]
+        if opcode == BLOCK:
+            pending = []
+            _flatten(args[0], code, labels + [pending])
+            _resolve(code, pending)
+        elif opcode == LOOP:
+            _flatten(args[0], code, labels + [len(code)])
+        elif opcode == BR or opcode == BR_IF or opcode == RETURN:
+            if opcode == RETURN:
+                opcode, label = BR, labels[0]
+            elif args[0] < len(labels):
+                label = labels[-1 - args[0]]
+            else:
+                raise RuntimeError(f"Bad branch depth {args[0]}")
+            if isinstance(label, list):
+                label.append(len(code))
+                label = None  # Filled in by _resolve()
+            code.append((opcode, (label,)))
+        elif opcode == CONST:
+            code.append((CONST, (float(args[0]),)))  # Everything is an f64
+        else:
+            code.append((opcode, tuple(args)))
+
+
+def _resolve(code, pending):
+    # Point the branches out of a block at the instruction following it
+    for index in pending:
+        opcode, _ = code[index]
+        code[index] = (opcode, (len(code),))
+
+
+def _fuse(code):
+    # Peephole pass replacing common runs of instructions with a single
+    # superinstruction.  Branch targets are remapped to the new positions,
+    # and a run is never fused across one.
+    targets = {args[0] for opcode, args in code if opcode == BR or opcode == BR_IF}
+    fused = []
+    moved = {}  # Old index -> new index
+    ip = 0
+    while ip < len(code):
+        moved[ip] = len(fused)
+        if (
+            _match(code, ip, (CONST, CONST, LOAD), targets)
+            and code[ip][1] == code[ip + 1][1]
+        ):
+            # The constant is pushed as is; only the load address is truncated
+            value = code[ip][1][0]
+            fused.append((PUSH_CONST_AND_LOAD, (value, int(value))))
+            ip += 3
+        elif _match(code, ip, (CONST, LOAD), targets):
+            # Same truncation _op_load() does, just once up front
+            fused.append((LOAD_CONST, (int(code[ip][1][0]),)))
+            ip += 2
+        elif _match(code, ip, (LOCAL_GET, LOCAL_GET, LOCAL_GET, MUL, ADD), targets):
+            fused.append(
+                (MADD_LOCALS, (code[ip][1][0], code[ip + 1][1][0], code[ip + 2][1][0]))
+            )
+            ip += 5
+        else:
+            fused.append(code[ip])
+            ip += 1
+    moved[ip] = len(fused)
+    for n, (opcode, args) in enumerate(fused):
+        if opcode == BR or opcode == BR_IF:
+            fused[n] = (opcode, (moved[args[0]],))
+    return fused
+
+
+def _match(code, ip, opcodes, targets):
+    # Does code[ip:] start with these opcodes, with nothing jumping into the
+    # middle of them?
+    return len(code) >= ip + len(opcodes) and all(
+        code[ip + n][0] == opcode and (n == 0 or ip + n not in targets)
+        for n, opcode in enumerate(opcodes)
+    )
+
+
+def _thread(code):
+    # Swap each opcode for its handler function.  The handler is the token,
+    # so _execute() calls it straight from the instruction with no table in
+    # between.
+    return [(_handlers[opcode], args) for opcode, args in code]
+
+
+def _nlocals(instructions):
+    # Locals are numbered densely from 0, so the highest index used says how
+    # many slots a call needs
+    count = 0
+    for op, *args in instructions:
+        if op == "local.get" or op == "local.set":
+            count = max(count, args[0] + 1)
+        elif op == "block" or op == "loop":
+            count = max(count, _nlocals(args[0]))
+    return count
+
+
+# Operators generated code may use, see _generate().  Comparisons go through
+# f64() so they give 1.0 or 0.0, like they do on the interpreter's stack.
+_leaf_binary = {
+    "add": "{} + {}",
+    "sub": "{} - {}",
+    "mul": "{} * {}",
+    "le": "f64({} <= {})",
+    "ge": "f64({} >= {})",
+}
+
+
+def _generate(code, returns, local, memory):
+    # Unroll straight-line code into the lines of a Python function body,
+    # with each stack slot held in a temporary.  Used by Function.compile()
+    # and Function._specialize(), which differ in how locals are named (the
+    # local format, e.g. "l{}") and whether load/store are allowed (memory),
+    # which go through the machine.  Returns (lines, namespace), the
+    # namespace holding the constants, or None for anything else.
+    namespace = {}
+    lines = []
+    stack = []
+    for op, *args in code:
+        temp = f"t{len(lines)}"
+        if op == "const":
+            if not isinstance(args[0], (int, float)):
+                return None
+            name = f"c{len(namespace)}"
+            namespace[name] = float(args[0])
+            lines.append(f"{temp} = {name}")
+        elif op == "local.get":
+            lines.append(f"{temp} = {local.format(args[0])}")
+        elif op == "local.set":
+            if not stack:
+                return None
+            lines.append(f"{local.format(args[0])} = {stack.pop()}")
+            continue
+        elif op == "load" and memory:
+            if not stack:
+                return None
+            lines.append(f"{temp} = machine.load(int({stack.pop()}))")
+        elif op == "store" and memory:
+            if len(stack) < 2:
+                return None
+            val = stack.pop()
+            addr = stack.pop()
+            lines.append(f"machine.store(int({addr}), {val})")
+            continue
+        elif op in _leaf_binary:
+            if len(stack) < 2:
+                return None
+            right = stack.pop()
+            left = stack.pop()
+            lines.append(f"{temp} = {_leaf_binary[op].format(left, right)}")
+        else:
+            return None
+        stack.append(temp)
+    # The interpreter would leave anything besides the result on the stack,
+    # which a Python function can't do
+    if len(stack) != (1 if returns else 0):
+        return None
+    if returns:
+        lines.append(f"return {stack[0]}")
+    return lines, namespace
+
+
+def _define(name, params, lines, namespace, filename):
+    # Turn generated lines into a function, see _generate()
+    source = f"def {name}({', '.join(params)}):\n" + "".join(
+        f"    {line}\n" for line in lines or ["pass"]
+    )
+    exec(compile(source, filename, "exec"), namespace)
+    return namespace[name]
+
+
+def _f64_array(values):
+    # f64() for generated code run on whole arrays, see call_vectorized()
+    return numpy.asarray(values, dtype=numpy.float64)
 
 
 class Function:
@@ -6,6 +261,102 @@ class Function:
         self.nparams = nparams
         self.returns = returns
         self.code = code
+        self.nlocals = max(nparams, _nlocals(code))
+        self._compiled_code = _compile(code)
+        self._compiled = self.compile()
+        self._specialized = None if self._compiled is not None else self._specialize()
+        self._vectorized = None  # Built on first use, see call_vectorized()
+        # Linked code and stack use for the table it was last called with,
+        # filled in by Machine._prepare()
+        self._table = None
+        self._code = None
+        self._depth = 0
+        self._verified = False
+
+    def compile(self):
+        # A leaf function that only does arithmetic on its locals can run as
+        # straight-line Python instead of going through the interpreter, e.g.
+        #
+        #     def _fn(l0, l1, l2):
+        #         l0 = f64(l0)
+        #         l1 = f64(l1)
+        #         l2 = f64(l2)
+        #         t0 = l0
+        #         t1 = l1
+        #         t2 = l2
+        #         t3 = t1 * t2
+        #         t4 = t0 + t3
+        #         return t4
+        #
+        # which Numba (if installed) then turns into native code.  Returns
+        # None for anything else, leaving the function on the interpreter.
+        fn = self._leaf(float)
+        if fn is not None and numba is not None:
+            fn = numba.njit(fn)
+        return fn
+
+    def _leaf(self, f64):
+        # The Python function behind compile().  Every value is an f64, so
+        # params go through f64() on the way in; call_vectorized() passes one
+        # that works on whole arrays.  Locals past the params start at 0.0,
+        # same as in the interpreter.
+        generated = _generate(self.code, self.returns, "l{}", memory=False)
+        if generated is None:
+            return None
+        lines, namespace = generated
+        namespace["f64"] = f64
+        lines[:0] = [f"l{n} = f64(l{n})" for n in range(self.nparams)] + [
+            f"l{n} = 0.0" for n in range(self.nparams, self.nlocals)
+        ]
+        params = [f"l{n}" for n in range(self.nparams)]
+        return _define("_fn", params, lines, namespace, "<leaf>")
+
+    def call_vectorized(self, *arrays):
+        # Run a leaf function over whole arrays of arguments at once, one
+        # element from each array per call.  With Numba the leaf becomes a
+        # parallel ufunc; otherwise the same Python code is handed NumPy
+        # arrays, so each operator works on the whole array.
+        if numpy is None:
+            raise RuntimeError("call_vectorized() needs NumPy")
+        if self._compiled is None or not self.returns:
+            raise RuntimeError("Only leaf functions that return can be vectorized")
+        if self._vectorized is None:
+            if numba is not None:
+                signature = f"f8({', '.join(['f8'] * self.nparams)})"
+                self._vectorized = numba.vectorize([signature], target="parallel")(
+                    self._leaf(float)
+                )
+            else:
+                self._vectorized = self._leaf(_f64_array)
+        arrays = [numpy.asarray(a, dtype=numpy.float64) for a in arrays]
+        shape = numpy.broadcast(*arrays).shape if arrays else ()
+        result = self._vectorized(*arrays)
+        # A result that doesn't depend on the arguments comes back as a single
+        # value, so spread it out to one per element
+        return numpy.broadcast_to(numpy.asarray(result, dtype=numpy.float64), shape)
+
+    def _specialize(self):
+        # Straight-line code that also touches memory can't go to Numba, but
+        # it can still skip the interpreter.  The body is unrolled into Python
+        # with the stack slots as temporaries, e.g.
+        #
+        #     def _run(machine, locals):
+        #         t0 = c0
+        #         t1 = c1
+        #         t2 = machine.load(int(t1))
+        #         t3 = locals[0]
+        #         t4 = t2 + t3
+        #         machine.store(int(t0), t4)
+        #
+        # Returns None for control flow and calls, which stay on the
+        # interpreter.
+        generated = _generate(self.code, self.returns, "locals[{}]", memory=True)
+        if generated is None:
+            return None
+        lines, namespace = generated
+        namespace["f64"] = float
+        lines[:0] = [f"locals[{n}] = f64(locals[{n}])" for n in range(self.nparams)]
+        return _define("_run", ["machine", "locals"], lines, namespace, "<specialized>")
 
 
 class ImportFunction:
@@ -18,113 +369,466 @@ class ImportFunction:
 class Machine:
     def __init__(self, functions, memsize=65536):
         self.functions = functions  # function table
-        self.items = []
+        # Every value is an f64 (addresses and comparison results included),
+        # so the stack is a flat array of doubles plus a stack pointer.  It
+        # only grows when a call needs more room than it has, see _reserve().
+        self._value_stack = array("d")
+        self._sp = 0
         self.memory = bytearray(memsize)
+        self.trace = False  # Print each instruction as it runs
 
     def load(self, addr):
-        return struct.unpack("<d", self.memory[addr : addr + 8])[0]
+        return _f64.unpack_from(self.memory, addr)[0]
 
     def store(self, addr, val):
-        self.memory[addr : addr + 8] = struct.pack("<d", val)
+        _f64.pack_into(self.memory, addr, val)
 
     def push(self, item):
-        self.items.append(item)
+        self._reserve(1)
+        self._value_stack[self._sp] = item
+        self._sp += 1
 
     def pop(self):
-        return self.items.pop()
+        if self._sp == 0:
+            raise RuntimeError("Stack underflow")
+        self._sp -= 1
+        return self._value_stack[self._sp]
+
+    def _reserve(self, depth):
+        # Make room for depth more values up front, so handlers can index the
+        # array without it ever resizing
+        short = self._sp + depth - len(self._value_stack)
+        if short > 0:
+            self._value_stack.extend(array("d", [0.0]) * short)
 
     def call(self, func, *args):
-        locals = dict(enumerate(args))  # {0: args[0], 1:args[1], 2: args[2]}
         # if the function is a normal Function, do what we had before
         if isinstance(func, Function):
-            try:
-                self.execute(func.code, locals)
-            except Return:
-                pass
             if func.returns:
-                return self.pop()
+                return self.call_ret_fn(func, *args)
+            return self.call_void_fn(func, *args)
         # if it's not a normal function and is instead in ImportFunction
         else:
             # return the value of calling the external thing
             return func.call(*args)
 
+    def call_ret_fn(self, func, *args):
+        # call() for a Function that returns a value
+        if func._compiled is not None:
+            return func._compiled(*args)  # Leaf function, see compile()
+        # Locals are a list indexed by slot; ones past the params start at 0.0
+        locals = [*args] + [0.0] * (func.nlocals - len(args))
+        if func._specialized is not None:
+            return func._specialized(self, locals)  # See _specialize()
+        self._interpret(func, locals)
+        return self.pop()
+
+    def call_void_fn(self, func, *args):
+        # call() for a Function that doesn't
+        if func._compiled is not None:
+            func._compiled(*args)
+            return
+        locals = [*args] + [0.0] * (func.nlocals - len(args))
+        if func._specialized is not None:
+            func._specialized(self, locals)
+        else:
+            self._interpret(func, locals)
+
+    def _interpret(self, func, locals):
+        # Run func's linked code, leaving any result on the stack
+        if func._table is not self.functions:
+            self._prepare(func)
+        self._reserve(func._depth)
+        if func._verified:
+            self._execute_verified(func._code, locals)
+        else:
+            self._execute(func._code, locals)
+
+    def _prepare(self, func):
+        # Link func against this function table and work out how it uses the
+        # stack, see _link() and _verify().  This happens on its first call,
+        # and again only if it's called with a different table.
+        code = _link(func._compiled_code, self.functions)
+        depth = _verify(code, func.returns)
+        func._verified = depth is not None
+        func._depth = depth if func._verified else _max_depth(code)
+        func._code = code
+        func._table = self.functions
+
+    def map(self, func_id, *arrays):
+        # Call function func_id once per element of the argument arrays, which
+        # must all be the same length.  The results come back as a list of
+        # floats (or of None, for a function that doesn't return anything).
+        # Leaf functions do it in one go when NumPy is around, see
+        # call_vectorized().
+        if len({len(array) for array in arrays}) > 1:
+            raise RuntimeError("map() needs arrays of the same length")
+        func = self.functions[func_id]
+        vectorize = numpy is not None and func.returns and bool(arrays)
+        if vectorize and isinstance(func, Function) and func._compiled is not None:
+            return func.call_vectorized(*arrays).tolist()
+        results = [self.call(func, *args) for args in zip(*arrays)]
+        if func.returns:
+            results = [float(result) for result in results]
+        return results
+
     def execute(self, instructions, locals):
-        for op, *args in instructions:
-            print(op, args, self.items)
-            if op == "const":
-                self.push(args[0])
-            elif op == "add":
-                right = self.pop()
-                left = self.pop()
-                self.push(left + right)
-            elif op == "sub":
-                right = self.pop()
-                left = self.pop()
-                self.push(left - right)
-            elif op == "mul":
-                right = self.pop()
-                left = self.pop()
-                self.push(left * right)
-            elif op == "load":
-                addr = self.pop()
-                self.push(self.load(addr))
-            elif op == "store":
-                var = self.pop()
-                addr = self.pop()
-                self.store(addr, var)
-            elif op == "local.get":
-                self.push(locals[args[0]])
-            elif op == "local.set":
-                locals[args[0]] = self.pop()
-            elif op == "call":
-                func = self.functions[args[0]]
-                # The underscore just means we're disregarding the variable.
-                fargs = reversed([self.pop() for _ in range(func.nparams)])
-                result = self.call(func, *fargs)
-                if func.returns:
-                    self.push(result)
-            elif op == "br":
-                raise Break(args[0])
-            elif op == "br_if":  # If the top thing on the stack is True, Break
-                if self.pop():
-                    raise Break(args[0])
-            elif op == "block":
-                try:
-                    self.execute(args[0], locals)
-                except Break as b:
-                    if b.level > 0:
-                        b.level -= 1
-                        raise
-            elif op == "loop":
-                while True:
-                    try:
-                        self.execute(args[0], locals)
-                        break
-                    except Break as b:
-                        if b.level > 0:
-                            b.level -= 1
-                            raise
-            elif op == "return":
-                raise Return()
-            elif op == "le":
-                right = self.pop()
-                left = self.pop()
-                self.push(left <= right)
-            elif op == "ge":
-                right = self.pop()
-                left = self.pop()
-                self.push(left >= right)
-            else:
-                raise RuntimeError(f"Bad op {op}")
+        # Top-level code is compiled like a function body, but it only runs
+        # this once, so it skips the leaf and specialized versions
+        code = _link(_compile(instructions), self.functions)
+        depth = _verify(code, False)
+        if depth is not None:
+            self._reserve(depth)
+            self._execute_verified(code, locals)
+        else:
+            self._reserve(_max_depth(code))
+            self._execute(code, locals)
+
+    def _execute(self, code, locals):
+        # Each instruction carries its own handler, which does the work and
+        # returns the index of the next instruction to run.  Handlers index
+        # the stack directly, so code that failed _verify() has each
+        # instruction's operands checked for before it runs.  Its depth isn't
+        # known up front either (a loop may leave values behind on every
+        # pass), so the stack grows as it goes.
+        stack = self._value_stack
+        trace = __debug__ and self.trace
+        ip = 0
+        end = len(code)
+        while ip < end:
+            handler, args = code[ip]
+            if trace:
+                print(handler.__name__[4:], args, stack[: self._sp].tolist())
+            if self._sp < _pops(handler, args):
+                raise RuntimeError("Stack underflow")
+            self._reserve(2)  # No instruction pushes more than two values
+            ip = handler(self, stack, args, locals, ip)
+
+    def _execute_verified(self, code, locals):
+        # Same as _execute(), minus the checks _verify() has already done
+        stack = self._value_stack
+        trace = __debug__ and self.trace
+        ip = 0
+        end = len(code)
+        while ip < end:
+            handler, args = code[ip]
+            if trace:
+                print(handler.__name__[4:], args, stack[: self._sp].tolist())
+            ip = handler(self, stack, args, locals, ip)
+
+
+# Opcode handlers.  These are plain functions rather than methods, called as
+# handler(machine, stack, args, locals, ip) and returning the next ip.
+
 
+def _op_const(machine, stack, args, locals, ip):
+    stack[machine._sp] = args[0]
+    machine._sp += 1
+    return ip + 1
 
-class Return(Exception):
-    pass
 
+def _op_add(machine, stack, args, locals, ip):
+    sp = machine._sp - 1
+    stack[sp - 1] += stack[sp]
+    machine._sp = sp
+    return ip + 1
 
-class Break(Exception):
-    def __init__(self, level):
-        self.level = level
+
+def _op_sub(machine, stack, args, locals, ip):
+    sp = machine._sp - 1
+    stack[sp - 1] -= stack[sp]
+    machine._sp = sp
+    return ip + 1
+
+
+def _op_mul(machine, stack, args, locals, ip):
+    sp = machine._sp - 1
+    stack[sp - 1] *= stack[sp]
+    machine._sp = sp
+    return ip + 1
+
+
+def _op_load(machine, stack, args, locals, ip):
+    sp = machine._sp - 1
+    stack[sp] = machine.load(int(stack[sp]))
+    return ip + 1
+
+
+def _op_store(machine, stack, args, locals, ip):
+    sp = machine._sp - 2
+    machine.store(int(stack[sp]), stack[sp + 1])
+    machine._sp = sp
+    return ip + 1
+
+
+def _op_local_get(machine, stack, args, locals, ip):
+    stack[machine._sp] = locals[args[0]]
+    machine._sp += 1
+    return ip + 1
+
+
+def _op_local_set(machine, stack, args, locals, ip):
+    machine._sp -= 1
+    locals[args[0]] = stack[machine._sp]
+    return ip + 1
+
+
+def _op_call(machine, stack, args, locals, ip):
+    # A call _link() couldn't find the function for, because the table
+    # didn't have it yet.  It's looked up each time it runs instead.
+    func = machine.functions[args[0]]
+    sp = machine._sp - func.nparams
+    if sp < 0:
+        raise RuntimeError("Stack underflow")
+    fargs = stack[sp : machine._sp]
+    machine._sp = sp
+    result = machine.call(func, *fargs)
+    if func.returns:
+        machine.push(result)
+    return ip + 1
+
+
+def _op_br(machine, stack, args, locals, ip):
+    return args[0]
+
+
+def _op_br_if(machine, stack, args, locals, ip):
+    # If the top thing on the stack is True, jump
+    machine._sp -= 1
+    if stack[machine._sp]:
+        return args[0]
+    return ip + 1
+
+
+def _op_le(machine, stack, args, locals, ip):
+    sp = machine._sp - 1
+    stack[sp - 1] = stack[sp - 1] <= stack[sp]
+    machine._sp = sp
+    return ip + 1
+
+
+def _op_ge(machine, stack, args, locals, ip):
+    sp = machine._sp - 1
+    stack[sp - 1] = stack[sp - 1] >= stack[sp]
+    machine._sp = sp
+    return ip + 1
+
+
+def _op_call_ret(machine, stack, args, locals, ip):
+    # call, linked to a Function that returns a value
+    func = args[0]
+    # The arguments are the top nparams values, already in order
+    sp = machine._sp - func.nparams
+    fargs = stack[sp : machine._sp]
+    machine._sp = sp
+    stack[sp] = machine.call_ret_fn(func, *fargs)
+    machine._sp = sp + 1
+    return ip + 1
+
+
+def _op_call_void(machine, stack, args, locals, ip):
+    # call, linked to a Function that doesn't
+    func = args[0]
+    sp = machine._sp - func.nparams
+    fargs = stack[sp : machine._sp]
+    machine._sp = sp
+    machine.call_void_fn(func, *fargs)
+    return ip + 1
+
+
+def _op_call_import_ret(machine, stack, args, locals, ip):
+    # call, linked to an ImportFunction that returns a value
+    func = args[0]
+    sp = machine._sp - func.nparams
+    fargs = stack[sp : machine._sp]
+    machine._sp = sp
+    stack[sp] = func.call(*fargs)
+    machine._sp = sp + 1
+    return ip + 1
+
+
+def _op_call_import_void(machine, stack, args, locals, ip):
+    # call, linked to an ImportFunction that doesn't
+    func = args[0]
+    sp = machine._sp - func.nparams
+    fargs = stack[sp : machine._sp]
+    machine._sp = sp
+    func.call(*fargs)
+    return ip + 1
+
+
+def _op_load_const(machine, stack, args, locals, ip):
+    stack[machine._sp] = machine.load(args[0])
+    machine._sp += 1
+    return ip + 1
+
+
+def _op_push_const_and_load(machine, stack, args, locals, ip):
+    sp = machine._sp
+    stack[sp] = args[0]
+    stack[sp + 1] = machine.load(args[1])
+    machine._sp = sp + 2
+    return ip + 1
+
+
+def _op_madd_locals(machine, stack, args, locals, ip):
+    stack[machine._sp] = locals[args[0]] + locals[args[1]] * locals[args[2]]
+    machine._sp += 1
+    return ip + 1
+
+
+# Handlers indexed by integer opcode
+_handlers = [
+    _op_const,
+    _op_add,
+    _op_mul,
+    _op_load,
+    _op_store,
+    _op_local_get,
+    _op_local_set,
+    _op_call,
+    _op_sub,
+    _op_br,
+    _op_br_if,
+    None,  # block, flattened by _compile()
+    None,  # loop, flattened by _compile()
+    None,  # return, compiled to br
+    _op_le,
+    _op_ge,
+    _op_load_const,
+    _op_push_const_and_load,
+    _op_madd_locals,
+]
+
+
+# Handlers _link() swaps in for call, which hold the function in args[0]
+_linked_calls = {
+    _op_call_ret,
+    _op_call_void,
+    _op_call_import_ret,
+    _op_call_import_void,
+}
+
+
+# How many values each handler takes off the stack.  Linked calls depend on
+# the callee, and _op_call() checks for itself.
+_inputs = {
+    _op_call: 0,
+    _op_const: 0,
+    _op_add: 2,
+    _op_mul: 2,
+    _op_load: 1,
+    _op_store: 2,
+    _op_local_get: 0,
+    _op_local_set: 1,
+    _op_sub: 2,
+    _op_br: 0,
+    _op_br_if: 1,
+    _op_le: 2,
+    _op_ge: 2,
+    _op_load_const: 0,
+    _op_push_const_and_load: 0,
+    _op_madd_locals: 0,
+}
+
+
+# Net change in stack height for each handler (calls depend on the callee)
+_effects = {
+    _op_call: 0,
+    _op_const: 1,
+    _op_add: -1,
+    _op_mul: -1,
+    _op_load: 0,
+    _op_store: -2,
+    _op_local_get: 1,
+    _op_local_set: -1,
+    _op_sub: -1,
+    _op_br: 0,
+    _op_br_if: -1,
+    _op_le: -1,
+    _op_ge: -1,
+    _op_load_const: 1,
+    _op_push_const_and_load: 2,
+    _op_madd_locals: 1,
+}
+
+
+def _max_depth(code):
+    # Stack height reached going through linked code in order, ignoring
+    # branches.  Only used as a starting size for code that fails _verify(),
+    # which grows the stack as it runs; _verify() works out the real depth
+    # for everything else.
+    depth = peak = 0
+    for handler, args in code:
+        depth += _effect(handler, args)
+        peak = max(peak, depth)
+    return peak
+
+
+def _pops(handler, args):
+    if handler in _linked_calls:
+        return args[0].nparams
+    return _inputs[handler]
+
+
+def _effect(handler, args):
+    if handler in _linked_calls:
+        return (1 if args[0].returns else 0) - args[0].nparams
+    return _effects[handler]
+
+
+def _verify(code, returns):
+    # Check that the stack can't underflow: follow every path through the
+    # code counting the values on the stack.  All paths into an instruction
+    # must agree on the count, and the code must finish with only its result
+    # (if it returns one) left behind.  Returns the highest count seen, which
+    # leaves out unreachable code, or None if the check fails.  Calls _link()
+    # couldn't resolve aren't known yet, so code with them fails too.
+    depths = {0: 0}
+    todo = [0]
+    while todo:
+        ip = todo.pop()
+        depth = depths[ip]
+        if ip == len(code):
+            if depth != (1 if returns else 0):
+                return None
+            continue
+        handler, args = code[ip]
+        if handler is _op_call or depth < _pops(handler, args):
+            return None
+        depth += _effect(handler, args)
+        if handler is _op_br:
+            targets = [args[0]]
+        elif handler is _op_br_if:
+            targets = [ip + 1, args[0]]
+        else:
+            targets = [ip + 1]
+        for target in targets:
+            if target not in depths:
+                depths[target] = depth
+                todo.append(target)
+            elif depths[target] != depth:
+                return None
+    return max(depths.values())
+
+
+def _link(code, functions):
+    # Calls name their function by its index in the table.  Once the table
+    # is known, each call is swapped for one that holds the function itself,
+    # with a separate handler for each kind of function and whether it
+    # returns a value.  Calls to functions the table doesn't have yet are
+    # left to _op_call().
+    linked = []
+    for handler, args in code:
+        if handler is _op_call and args[0] < len(functions):
+            func = functions[args[0]]
+            if isinstance(func, Function):
+                handler = _op_call_ret if func.returns else _op_call_void
+            else:
+                handler = _op_call_import_ret if func.returns else _op_call_import_void
+            args = (func,)
+        linked.append((handler, args))
+    return linked
 
 
 def example():
@@ -146,6 +146,7 @@ class Machine:
         self.functions = functions  # function table
         self.items = []
         self.memory = bytearray(memsize)
+        self._break = Break(0)  # Raised by every branch, see _branch()
 
     def load(self, addr):
         return struct.unpack("<d", self.memory[addr : addr + 8])[0]
@@ -160,6 +161,12 @@ class Machine:
     def pop(self):
         return self.items.pop()
 
+    def _branch(self, level):
+        # Reuse the one Break instead of creating an exception per branch.
+        # Its old traceback is dropped so it doesn't grow with every raise.
+        self._break.level = level
+        return self._break.with_traceback(None)
+
     def call(self, func, *args):
         locals = dict(enumerate(args))  # { 0: args[0], 1: args[1], 2: args[2] }
         if isinstance(func, Function):
@@ -226,17 +233,17 @@ class Machine:
                     self.push(result)
 
             elif op == "br":
-                raise Break(args[0])
+                raise self._branch(args[0]) from None
 
             elif op == "br_if":
                 if self.pop():
-                    raise Break(args[0])
+                    raise self._branch(args[0]) from None
             elif op == "br_table":  # (br_tabel, [], default)
                 n = self.pop()
                 if n < len(args[0]):
-                    raise Break(args[0][n])
+                    raise self._branch(args[0][n]) from None
                 else:
-                    raise Break(args[1])
+                    raise self._branch(args[1]) from None
             elif op == "block":  # ('block', type, [ instructions ])
                 try:
                     self.execute(args[1], locals)